@@ -25,12 +25,12 @@ from matplotlib.dates import date2num
 from datetime import datetime as dt
 import seaborn as sns
 from datetime import date
-import geopy.distance
-from fastkml import kml
+from lxml import etree
 from matplotlib import path
 import os as os
+import functools
 import pygmt
-from scipy.optimize import leastsq
+import scipy.optimize
 import cartopy.io.img_tiles as cimgt
 import cartopy.crs as ccrs
 import scipy.signal
@@ -39,24 +39,76 @@ import scipy.signal
 
 FEET_TO_MM = 304.8
 
+# The only columns of the PBO GPS csvs which get used; everything else is skipped at read time.
+GPS_COLUMNS = ['Date','North (mm)','East (mm)','Vertical (mm)']
+GPS_DTYPES = {'North (mm)':'float32','East (mm)':'float32','Vertical (mm)':'float32'}
+
 
 #%% 1. Functions which import things
 
-def import_InSAR_csv(filename):
-    '''Imports InSAR data as a Pandas DataFrame. 'InSAR data' needs to be a csv file downloaded from the ksat maps tool, or another InSAR dataset in the same format. To download an appropriate csv from ksat tools, use the polygon selection tool and click the green CSV button.'''
+def import_InSAR_csv(filename,cache=True):
+    '''Imports InSAR data as a Pandas DataFrame. 'InSAR data' needs to be a csv file downloaded from the ksat maps tool, or another InSAR dataset in the same format. To download an appropriate csv from ksat tools, use the polygon selection tool and click the green CSV button.
+    
+    If cache is True, the parsed data is also written next to the csv as filename.parquet, and later imports read that instead (much quicker) for as long as it is newer than the csv.'''
     fileloc = '%s' % filename
     print('Importing InSAR data from: "%s".' % fileloc)
     print('\tFilesize found to be %s.' % file_size(fileloc))
-    csvData = pd.read_csv(fileloc,sep=',',skipinitialspace=True)
-    
-    if 'X' in csvData.columns:
-        print('\tRenaming columns from X/Y to latitude/longitude.')
-        csvData.rename(columns={'X':'Longitude', 'Y':'Latitude'},inplace=True)
     
-    if 'latitude' in csvData.columns:
-        print('\tRenaming columns from latitude/longitude to Latitude/Longitude.')
-        csvData.rename(columns={'longitude':'Longitude', 'latitude':'Latitude'},inplace=True)
-
+    pq_path = fileloc + '.parquet'
+    csvData = None
+    if cache and os.path.isfile(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(fileloc):
+        print('\tReading cached copy from: "%s".' % pq_path)
+        try:
+            csvData = pd.read_parquet(pq_path,engine='pyarrow')
+        except Exception as e:
+            print('\tUnable to read parquet cache (%s); re-parsing the csv.' % e)
+            csvData = None
+    from_cache = csvData is not None
+    
+    if not from_cache:
+        # Peek at the header so we can give every column an explicit dtype: float32 for the displacements, float64 for the coordinates.
+        rawcols = pd.read_csv(fileloc,sep=',',nrows=0).columns
+        cols = rawcols.str.strip()
+        dtype = dict.fromkeys(cols[cols.str.startswith('20')],'float32')
+        dtype.update(dict.fromkeys(cols[cols.isin(['Latitude','Longitude','latitude','longitude','X','Y'])],'float64'))
+        
+        # The pyarrow parser is multithreaded and much quicker than the default one, but it doesn't support skipinitialspace. Files separated by ', ' go straight to the C parser; otherwise try pyarrow and fall back to the C parser if it isn't installed or chokes.
+        if (rawcols == cols).all():
+            try:
+                csvData = pd.read_csv(fileloc,sep=',',engine='pyarrow')
+                csvData.columns = csvData.columns.str.strip()
+                csvData = csvData.astype(dtype)
+            except (ImportError,ValueError):
+                print('\tpyarrow unable to parse the file; falling back to the default csv parser.')
+                csvData = None
+        if csvData is None:
+            csvData = pd.read_csv(fileloc,sep=',',skipinitialspace=True,dtype=dtype)
+        
+        if 'X' in csvData.columns:
+            print('\tRenaming columns from X/Y to latitude/longitude.')
+            csvData.rename(columns={'X':'Longitude', 'Y':'Latitude'},inplace=True)
+        
+        if 'latitude' in csvData.columns:
+            print('\tRenaming columns from latitude/longitude to Latitude/Longitude.')
+            csvData.rename(columns={'longitude':'Longitude', 'latitude':'Latitude'},inplace=True)
+    
+    # Displacements (mm) only need float32 precision, which halves the memory and the work in every later mean/median/detrend. Coordinates stay float64.
+    date_cols = csvData.columns[csvData.columns.str.startswith('20')]
+    if (csvData.dtypes[date_cols] != 'float32').any():
+        print('\tDowncasting displacements to float32.')
+        csvData[date_cols] = csvData[date_cols].astype('float32',copy=False)
+
+    if cache and not from_cache:
+        # Write to a temporary file and move it into place, so an interrupted write never leaves a truncated cache behind.
+        tmp_path = pq_path + '.tmp'
+        try:
+            csvData.to_parquet(tmp_path,engine='pyarrow',compression='zstd',index=False)
+            os.replace(tmp_path,pq_path)
+            print('\tCached parsed data to: "%s".' % pq_path)
+        except Exception as e:
+            print('\tUnable to write parquet cache (%s); continuing without it.' % e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
     
     print('\tSuccessfully imported data of size %ix%i.\n' % (csvData.shape[0],csvData.shape[1]) )
     return csvData
@@ -87,10 +139,9 @@ def import_GPS_data(filename,path_to_folder='data'):
 #    
 #    gpsdates = date2num(gpsdates_list)
     
-    csvdata= pd.read_csv(fileloc,header=11,delimiter=',',skipinitialspace=True)
+    csvdata= pd.read_csv(fileloc,header=11,delimiter=',',skipinitialspace=True,usecols=GPS_COLUMNS,dtype=GPS_DTYPES)
     datesgps = csvdata['Date']
-    gpsdates_list = [dt.strptime(date, '%Y-%m-%d').date() for date in datesgps]    
-    gpsdates = date2num(gpsdates_list)
+    gpsdates = date2num(pd.to_datetime(datesgps, format='%Y-%m-%d', cache=True).to_numpy())
     
     Data = np.vstack((csvdata['North (mm)'],csvdata['East (mm)'],csvdata['Vertical (mm)'])) 
     
@@ -112,10 +163,9 @@ def import_GPS_data_new(station_name,update=0,ref_frame='nam08',solution='pbo',s
         
     print('Importing GPS data from: "%s".' % fileloc)
    
-    csvdata= pd.read_csv(fileloc,header=11,delimiter=',',skipinitialspace=True)
+    csvdata= pd.read_csv(fileloc,header=11,delimiter=',',skipinitialspace=True,usecols=GPS_COLUMNS,dtype=GPS_DTYPES)
     datesgps = csvdata['Date']
-    gpsdates_list = [dt.strptime(date, '%Y-%m-%d').date() for date in datesgps]    
-    gpsdates = date2num(gpsdates_list)
+    gpsdates = date2num(pd.to_datetime(datesgps, format='%Y-%m-%d', cache=True).to_numpy())
     
     #Data = np.vstack((csvdata['North (mm)'],csvdata['East (mm)'],csvdata['Vertical (mm)'])) 
     if startdate:
@@ -144,58 +194,31 @@ def import_GPS_data_new(station_name,update=0,ref_frame='nam08',solution='pbo',s
 def import_kml_line(filename):
     '''import a single .kml line created in Google Earth. Note that this will probably import only the first segment of 'multi segment' lines. Which is fine......'''
     
-    kml_file = filename # Name of the kml file
-    
-    # Load the file as a string, skipping the first line because for some reason fastkml cannot deal with that...
-    with open(kml_file, 'rt', encoding="utf-8") as myfile:
-        doc=myfile.readlines()[1:]
-        myfile.close()
-    doc = ''.join(doc) # gets it as a string
-    
-    # Using the very opaque fastkml module to parse out the features. I wonder if the length of features is 2 if it's a 2-segment line..?
-    k = kml.KML()
-    k.from_string(doc)
-    features = list(k.features())
-    
-    # Extract the first feature and a LineString object corresponding to it!
-    f1 = list(features[0].features())
-    t = f1[0].geometry
-    
     # Get the coordinates of the line's nodes.
-    xy = t.xy
-    x0 = xy[0][0]
-    x1 = xy[0][1]
-    y0 = xy[1][0]
-    y1 = xy[1][1]
+    A = _kml_coordinates(filename,"//*[local-name()='LineString']/*[local-name()='coordinates']")
+    x0 = A[0,0]
+    x1 = A[1,0]
+    y0 = A[0,1]
+    y1 = A[1,1]
     
     return x0,x1,y0,y1
 
 def import_kml_polygon(filename):
     '''import a single .kml polygon created in Google Earth. Should work in simple cases.......'''
     
-    kml_file = filename # Name of the kml file
-    
-    # Load the file as a string, skipping the first line because for some reason fastkml cannot deal with that...
-    with open(kml_file, 'rt', encoding="utf-8") as myfile:
-        doc=myfile.readlines()[1:]
-        myfile.close()
-    doc = ''.join(doc) # gets it as a string
-    
-    # Using the very opaque fastkml module to parse out the features. I wonder if the length of features is 2 if it's a 2-segment line..?
-    k = kml.KML()
-    k.from_string(doc)
-    features = list(k.features())
-    
-    # Extract the first feature and a LineString object corresponding to it!
-    f1 = list(features[0].features())
-    t = f1[0].geometry
-
-    A = np.array(t.exterior.coords)
+    A = _kml_coordinates(filename,"//*[local-name()='outerBoundaryIs']//*[local-name()='coordinates']")
     Polylon = A[:,0]
     Polylat = A[:,1]
     
     return Polylon, Polylat
 
+def _kml_coordinates(filename,xpath):
+    '''Returns an array of [lon, lat] rows from the first <coordinates> element of a .kml file matched by xpath. Matching is on local-name so it doesn't care which KML namespace Google Earth wrote.'''
+    tree = etree.parse(filename)
+    coords_text = tree.xpath(xpath)[0].text
+    # Each node is 'lon,lat' or 'lon,lat,alt'; nodes are separated by whitespace.
+    return np.array([node.split(',')[:2] for node in coords_text.split()],dtype=float)
+
 def import_reservoir_data(filename):
     '''Imports reservoir data, when the aforementioned data is of the format outlined here, taken from the Readme.txt in "Study_Area/Reservoir_Data":
         Contains daily reservoir level data for the reservoirs/lakes in the study area.
@@ -214,8 +237,7 @@ def import_reservoir_data(filename):
     storage[np.where(storage==0)] = np.nan # I assume no months have 0.00 as their reservoir level, else those months would now not be plotted. (Reasonable..)
     
     dates= Data['DATE / TIME (PST)']
-    dates= [dt.strptime(date, '%m/%d/%Y').date() for date in dates]
-    dates = date2num(dates)
+    dates = date2num(pd.to_datetime(dates, format='%m/%d/%Y', cache=True).to_numpy())
     return storage,dates
 
 
@@ -229,8 +251,7 @@ def import_well_seasonaltimeseries(filename):
     dates2 = [date.replace('Fall','Sep') for date in dates]
     dates2 = [date.replace('Spring','May') for date in dates2]
     
-    dates= [dt.strptime(date, '%b%Y').date() for date in dates2]
-    dates = date2num(dates)
+    dates = date2num(pd.to_datetime(dates2, format='%b%Y', cache=True).to_numpy())
     return csvData, dates
 
 #%% 2. Functions which extract subsets of inSAR data.
@@ -238,10 +259,17 @@ def import_well_seasonaltimeseries(filename):
 def extract_from_polygon(Polylon,Polylat,Data):
     '''Takes a Pandas Dataframe Data, and a polygon defined by it's (ordered) lon and lat coordinates, and returns a Pandas Datarfame corresponding to data only within that polygon.'''
     
-    lat = np.array(Data['Latitude'])
-    lon = np.array(Data['Longitude'])
-        
-    inbox = inpolygon(np.asarray(lon),np.asarray(lat),np.asarray(Polylon),np.asarray(Polylat))
+    lat = Data['Latitude'].to_numpy()
+    lon = Data['Longitude'].to_numpy()
+    Polylon = np.asarray(Polylon)
+    Polylat = np.asarray(Polylat)
+    
+    # Cheap bounding box test first, so that the point-in-polygon test only runs on pixels which could possibly be inside.
+    inbbox = (lon >= Polylon.min()) & (lon <= Polylon.max()) & (lat >= Polylat.min()) & (lat <= Polylat.max())
+    idx_bbox = np.flatnonzero(inbbox)
+    
+    inbox = np.zeros(len(lon),dtype=bool)
+    inbox[idx_bbox] = inpolygon(lon[idx_bbox],lat[idx_bbox],Polylon,Polylat)
     Datafilt = Data[inbox]
     return Datafilt
 
@@ -249,20 +277,15 @@ def extract_series_from_latlon(lat,lon,Data,factor=1):
     '''Returns the time series for a given latitude and longitude pair. First finds the nearest pixel to your lat/lon, then extracts the series. Optionally scale the data by a factor (eg to go from LOS to vertical, etc).
     
     Returns: dates, Series.'''
-    dist = np.array(np.sqrt((Data["Latitude"] - lat)**2 + (Data["Longitude"] - lon)**2))
-    if np.min(dist) >= 0.5:
+    index, dist = _nearest_pixel(Data,lat,lon)
+    if dist >= 0.5:
         raise Exception("No pixels found within 0.5 degree of given lat/lon.")
-    index = np.argmin(dist)
 
-    headings = list(Data.columns.values)
-    idx_firstdate=np.where([head.startswith('20') for head in headings])[0][0]
-    dates = headings[idx_firstdate:]
-    dates_list = [dt.strptime(date, '%Y%m%d').date() for date in dates]
-    dates = date2num(dates_list)
+    idx_firstdate, date_cols, dates = _insar_meta(Data)
     
-    Series = factor * Data.iloc[index,idx_firstdate:]
+    Series = factor * Data.iloc[index,idx_firstdate:].to_numpy()
     
-    return dates,Series
+    return dates.copy(),Series
 
 #%% 3. Functions which plot things.
 
@@ -276,26 +299,26 @@ def plot_average_series(Data,avg='both',detrended=False,feet=False,newfig=True):
         fig = plt.gcf()
         ax = plt.gca()
     
-    headings = list(Data.columns.values)
-    idx_firstdate=np.where([head.startswith('20') for head in headings])[0][0]
+    idx_firstdate, date_cols, dates = _insar_meta(Data)
     print('\tFirst date is found in column %i' % idx_firstdate)
-    dates = headings[idx_firstdate:]
-    dates_list = [dt.strptime(date, '%Y%m%d').date() for date in dates]
-    dates = date2num(dates_list)
     
-    Series = Data[Data.columns[idx_firstdate:]].values
+    Series = Data[list(date_cols)].values
+    
+    pal = sns.color_palette(palette="RdBu",n_colors=10).as_hex()[::-1]
     
+    # Linear detrending commutes with the mean, so detrend the 1-D mean rather than every pixel. It doesn't commute with the median, so that still needs each pixel series detrending first, but only if the median is going to be plotted.
+    mean_def = np.mean(Series,axis=0)
+    median_series = Series
     if detrended:
         print('\t Detrending InSAR series for plot.')
-        Series = scipy.signal.detrend(Series)
+        mean_def = scipy.signal.detrend(mean_def)
+        if avg in ('both','median'):
+            median_series = scipy.signal.detrend(Series,axis=1)
+    median_def = np.median(median_series,axis=0)
     
     if feet:
-        Series = FEET_TO_MM * Series
-    
-    pal = sns.color_palette(palette="RdBu",n_colors=10).as_hex()[::-1]
-    
-    mean_def = np.mean(Series,axis=0)
-    median_def = np.median(Series,axis=0)
+        mean_def = FEET_TO_MM * mean_def
+        median_def = FEET_TO_MM * median_def
     
     if avg == 'both': 
         ax.plot_date(dates,mean_def,linestyle='solid',label='Mean')
@@ -328,10 +351,9 @@ def plot_average_series(Data,avg='both',detrended=False,feet=False,newfig=True):
 
 def plot_series_latlon(Data,lat,lon,factor=1,newFig=True):
     '''Plots the time series for a given latitude and longitude pair. First finds the nearest pixel to your lat/lon, then plots the series. Optionally scale the data by a factor (eg to go from LOS to vertical, etc).'''
-    dist = np.array(np.sqrt((Data["Latitude"] - lat)**2 + (Data["Longitude"] - lon)**2))
-    if np.min(dist) >= 1:
+    index, dist = _nearest_pixel(Data,lat,lon)
+    if dist >= 1:
         raise Exception("No pixels found within 1 degree of given lat/lon.")
-    index = np.argmin(dist)
     
     if newFig:
         fig = plt.figure(figsize=(18,12))
@@ -340,13 +362,9 @@ def plot_series_latlon(Data,lat,lon,factor=1,newFig=True):
         fig = plt.gcf()
         ax = plt.gca()
 
-    headings = list(Data.columns.values)
-    idx_firstdate=np.where([head.startswith('20') for head in headings])[0][0]
-    dates = headings[idx_firstdate:]
-    dates_list = [dt.strptime(date, '%Y%m%d').date() for date in dates]
-    dates = date2num(dates_list)
+    idx_firstdate, date_cols, dates = _insar_meta(Data)
     
-    Series = factor * Data.iloc[index,idx_firstdate:]
+    Series = factor * Data.iloc[index,idx_firstdate:].to_numpy()
 
     ax.plot_date(dates,Series,linestyle='solid')
     return fig, ax
@@ -356,7 +374,7 @@ def plot_line_with_boxes(x0,x1,y0,y1,BOXESX,BOXESY,lats,lons,fig,colours='RdBu',
         
     coords1 = (y0,x0)
     coords2 = (y1,x1)
-    Len = geopy.distance.distance(coords1, coords2).m
+    Len = _haversine_m(*coords1, *coords2)
     
     # get vectors with length 1m parallel and perpendicular to the line
     linevector = np.array([x1-x0,y1-y0])
@@ -420,10 +438,23 @@ def plot_map_finaltimestep(Data,backgroundquality=10,projection="M8i",region="ti
     # Normalise the displacement on the final timestep
     print('\tNormalising displacement (pygmt currently only plots values between 0 and 1).')
     finaltime = list(Data.columns.values)[-1]
-    normalised_displacement=0.5*(Data[finaltime]/ np.max([np.max(Data[finaltime]),np.abs(np.min(Data[finaltime]))]) + 1)
+    finaldisp = Data[finaltime].to_numpy()
+    normalised_displacement=0.5*(finaldisp/np.nanmax(np.abs(finaldisp)) + 1)
+
+    # Rasterise the pixels onto a regular grid of spacing pixelsize (eg 250e = 250m) so GMT draws one image rather than one rectangle per pixel. Each node takes the pixels within one pixelsize of it (a single sector is enough), so the InSAR pixel lattice and the lon/lat node lattice needn't line up for the grid to be gap free.
+    print('\tGridding InSAR data.')
+    lon = Data["Longitude"].to_numpy()
+    lat = Data["Latitude"].to_numpy()
+    valid = ~np.isnan(normalised_displacement)
+    # Always grid over the data extent only, padded by a pixel each side so a single row/column of pixels still gives a valid region; grdimage clips to the plotting region R anyway, and gridding over eg the whole of CVSouth would make a huge, mostly empty grid.
+    pad_lat = _gmt_distance_to_degrees(pixelsize)
+    pad_lon = pad_lat / np.cos(np.radians(np.mean(lat)))
+    gridregion = [np.min(lon)-pad_lon,np.max(lon)+pad_lon,np.min(lat)-pad_lat,np.max(lat)+pad_lat]
+    grid = pygmt.nearneighbor(data=np.c_[lon,lat,normalised_displacement][valid],spacing=pixelsize,search_radius=pixelsize,sectors=1,region=gridregion)
 
     print('\tPlotting InSAR data.')
-    fig.plot(x=Data["Longitude"],y=Data["Latitude"],style="J-%s" % pixelsize,color=normalised_displacement,pen=False,cmap=cmap) # style = J-250e means 250m edge length rectangles
+    pygmt.makecpt(cmap=cmap,series=[0,1])
+    fig.grdimage(grid=grid,cmap=True,projection=projection,region=R,nan_transparent=True)
 
     print('\tRendering, saving, displaying.')
     fig.savefig("points.tmp.pdf",show=True,crop=True)
@@ -452,27 +483,24 @@ def plot_individual_gps_station_vertical(station_name,startdate=False,enddate=Fa
     
 def fit_straight_line_to_series(Series,dates):
     '''Fits a straight line and returns misfit, est_slope, est_intercept.'''
-    N = len(Series) # number of data points
-    t = dates
-    #f = 1.15247 # Optional!! Advised not to use
-    data = Series # create artificial data with noise
-    
-    guess_intercept = Series[0]
-    guess_slope = (np.max(Series) - np.min(Series)) / (t[-1]-t[0])
-    
-    # we'll use this to plot our first estimate. This might already be good enough for you
-    #data_first_guess = guess_std*np.sin(guess_freq*t+guess_phase) + guess_mean
-    
-    # Define the function to optimize, in this case, we want to minimize the difference
-    # between the actual data and our "guessed" parameters
-    optimize_func = lambda x: x[0]*(t-t[0]) +x[1] - data
-    est_slope, est_intercept = leastsq(optimize_func, [guess_slope, guess_intercept])[0]
+    misfits,est_slopes,est_intercepts = fit_lines_batch(np.atleast_2d(np.asarray(Series)),dates)
+
+    return misfits[0],est_slopes[0],est_intercepts[0]
+
+def fit_lines_batch(Series2D,dates):
+    '''Fits a straight line to every row of Series2D (shape npixels x ndates, all sharing the same dates) in one least squares solve. Returns arrays misfits, est_slopes, est_intercepts, one entry per row.'''
+    t = np.asarray(dates,dtype=float)
+    data = np.asarray(Series2D)
     
+    # The model slope*(t-t[0]) + intercept is linear, so every pixel can be solved at once against the same design matrix.
+    A = np.column_stack([t - t[0], np.ones_like(t)])
+    coefs = np.linalg.lstsq(A, data.T, rcond=None)[0]
+    est_slopes, est_intercepts = coefs[0], coefs[1]
     
-    data_fit=est_slope * (t - t[0]) + est_intercept
-    misfit = np.sum( np.sqrt(np.abs((Series**2 - data_fit**2))))/len(dates)#    plt.figure()
+    data_fit = A @ coefs
+    misfits = np.sum( np.abs(data.T - data_fit), axis=0)/len(t)
 
-    return misfit,est_slope,est_intercept
+    return misfits,est_slopes,est_intercepts
 
 
 def fit_sinusoid_to_series(Series,dates):
@@ -493,17 +521,30 @@ def fit_sinusoid_to_series(Series,dates):
     # we'll use this to plot our first estimate. This might already be good enough for you
     #data_first_guess = guess_std*np.sin(guess_freq*t+guess_phase) + guess_mean
     
-    # Define the function to optimize, in this case, we want to minimize the difference
-    # between the actual data and our "guessed" parameters
-    func = lambda x: x[0]* np.sin( (2*np.pi*(t-t[0]-x[2])) / x[1]  ) + x[3]
-    
-    
-    optimize_func = lambda x: np.linalg.norm(x[0]* np.sin( (2*np.pi*(t-t[0]-x[2])) / x[1]  ) + x[3] - data)
-    sln = scipy.optimize.minimize(optimize_func, guess,bounds=bnds)
+    # Minimise the residuals between the actual data and our "guessed" parameters, handing the optimiser the analytical Jacobian so it doesn't have to finite-difference it.
+    lower, upper = np.array(bnds).T
+    guess = np.clip(guess,lower,upper)
+    tt = np.asarray(t - t[0],dtype=float)
+    sln = scipy.optimize.least_squares(_sinusoid_residual, guess, jac=_sinusoid_jacobian, bounds=(lower,upper), args=(tt,np.asarray(data,dtype=float)))
     est_amp, est_period, est_phase, est_mean = sln.x
-    misfit = sln.fun / len(t)
+    misfit = np.linalg.norm(sln.fun) / len(t)
     return misfit,est_amp,est_period,est_phase,est_mean
 
+def _sinusoid_residual(x,tt,data):
+    '''Residual of the sinusoid x[0]*sin(2pi(tt-x[2])/x[1]) + x[3] against data.'''
+    return x[0]* np.sin( (2*np.pi*(tt-x[2])) / x[1]  ) + x[3] - data
+
+def _sinusoid_jacobian(x,tt,data):
+    '''Analytical Jacobian of _sinusoid_residual with respect to [amp, period, phase, mean].'''
+    theta = (2*np.pi*(tt-x[2])) / x[1]
+    cos_theta = np.cos(theta)
+    jac = np.empty((len(tt),4))
+    jac[:,0] = np.sin(theta)
+    jac[:,1] = -x[0]*cos_theta*theta/x[1]
+    jac[:,2] = -x[0]*cos_theta*2*np.pi/x[1]
+    jac[:,3] = 1
+    return jac
+
 
 #%% 5. Miscellaneous functions.
 
@@ -513,7 +554,7 @@ def segment_line_to_boxes(x0,x1,y0,y1, spacing, width):
     # Calculate the length of the line
     coords1 = (y0,x0)
     coords2 = (y1,x1)
-    Len = geopy.distance.distance(coords1, coords2).m
+    Len = _haversine_m(*coords1, *coords2)
     
     nopoints = int(np.floor(Len/spacing)) # calculate number of boxes
     
@@ -525,33 +566,28 @@ def segment_line_to_boxes(x0,x1,y0,y1, spacing, width):
     perpvector = np.empty_like(linevector)
     perpvector[0] = -linevector[1]
     perpvector[1] = linevector[0]
-    NormLen = geopy.distance.distance((0,0),(perpvector[0],perpvector[1])).m    
+    NormLen = _haversine_m(0,0,perpvector[0],perpvector[1])
     unitnorm = 1/NormLen * perpvector
         
-    BOXESX = np.zeros((len(lats)-1,5))
-    BOXESY = np.zeros_like(BOXESX)
-    
-    for i in range(0,len(lats)-1):
-        
-        topright = (lons[i]-unitnorm[0]*width, lats[i]-unitnorm[1]*width)
-        topleft = (lons[i+1]-unitnorm[0]*width, lats[i+1]-unitnorm[1]*width)
-        botright = (lons[i]+unitnorm[0]*width, lats[i]+unitnorm[1]*width)
-        botleft = (lons[i+1]+unitnorm[0]*width, lats[i+1]+unitnorm[1]*width)
-        
-        rectx = [topright[0], topleft[0], botleft[0], botright[0],topright[0]]
-        recty = [topright[1], topleft[1], botleft[1], botright[1],topright[1]]
-        
-        BOXESX[i,:] = rectx
-        BOXESY[i,:] = recty
+    # Corners of every box at once; each row of BOXESX/BOXESY is topright, topleft, botleft, botright, topright.
+    dx, dy = unitnorm*width
+    BOXESX = np.column_stack((lons[:-1]-dx, lons[1:]-dx, lons[1:]+dx, lons[:-1]+dx, lons[:-1]-dx))
+    BOXESY = np.column_stack((lats[:-1]-dy, lats[1:]-dy, lats[1:]+dy, lats[:-1]+dy, lats[:-1]-dy))
     
     return BOXESX, BOXESY, lats, lons
 
 def remove_rows_all_zeros(Data):
     '''Takes a Pandas InSAR dataframe and returns one where rows containing only zeros are removed. Initially designed with the TRE dataset in mind.'''
     print('Removing rows with only zeros.')
-    print("\tDon't worry, this one tends to hang for ages but it does work..give it a minute or so.")
-    data_raw = Data.drop(['Longitude','Latitude'],axis=1)
-    booool = (data_raw.T != 0).any()
+    data_cols = Data.columns[~Data.columns.isin(['Longitude','Latitude'])]
+    
+    # Work through the data a chunk of columns at a time so memory use stays bounded, stopping early once every row is known to be kept.
+    booool = np.zeros(len(Data),dtype=bool)
+    chunk = 64
+    for i in range(0,len(data_cols),chunk):
+        booool |= np.any(Data[data_cols[i:i+chunk]].to_numpy() != 0,axis=1)
+        if booool.all():
+            break
     data_filtered = Data[booool]
     return data_filtered
 
@@ -569,10 +605,9 @@ def rezero_series(series,dates,zerodate,zerodateasfloat=0):
 
 def get_mean_series(Data):
     '''Takes a Pandas Dataframe and returns single dataseries corresponding to the mean deformation at each timestep in the origianl data.'''
-    headings = list(Data.columns.values)
-    idx_firstdate=np.where([head.startswith('20') for head in headings])[0][0]
+    idx_firstdate, date_cols, dates = _insar_meta(Data)
 
-    Series = Data[Data.columns[idx_firstdate:]].values
+    Series = Data[list(date_cols)].values
     mean_def = np.mean(Series,axis=0)
     n = Data.shape[0]
     #median_def = np.median(Series,axis=0)
@@ -585,18 +620,54 @@ def inpolygon(xq, yq, xv, yv):
     yq = yq.reshape(-1)
     xv = xv.reshape(-1)
     yv = yv.reshape(-1)
-    q = [(xq[i], yq[i]) for i in range(xq.shape[0])]
-    p = path.Path([(xv[i], yv[i]) for i in range(xv.shape[0])])
-    return p.contains_points(q).reshape(shape)
+    q = np.column_stack((xq, yq))
+    p = path.Path(np.column_stack((xv, yv)))
+    return p.contains_points(q,radius=0.0).reshape(shape)
+
+def _nearest_pixel(Data,lat,lon):
+    '''Returns the row index of the pixel in Data nearest to lat/lon, and its distance in degrees. Works on the raw Latitude/Longitude arrays and only takes the square root of the minimum.'''
+    dlat = Data['Latitude'].to_numpy() - lat
+    dlon = Data['Longitude'].to_numpy() - lon
+    dist2 = dlat*dlat
+    dist2 += dlon*dlon
+    index = np.argmin(dist2)
+    return index, np.sqrt(dist2[index])
 
 def get_dates(Data):
     '''Takes a Pandas Dataframe and returns a list of numeric dates in a format which they can be plotted using plt.plot_date().'''
-    headings = list(Data.columns.values)
-    idx_firstdate=np.where([head.startswith('20') for head in headings])[0][0]
-    dates = headings[idx_firstdate:]
-    dates_list = [dt.strptime(date, '%Y%m%d').date() for date in dates]
-    dates = date2num(dates_list)
-    return dates
+    idx_firstdate, date_cols, dates = _insar_meta(Data)
+    return dates.copy()
+
+def _insar_meta(Data):
+    '''Finds the first date column (heading starting '20', format YYYYMMDD) of an InSAR dataframe and returns idx_firstdate, date_cols (a tuple), numeric dates (read-only). Memoised on the column headings so repeated calls don't rescan or reparse them.'''
+    return _insar_meta_from_columns(tuple(Data.columns))
+
+@functools.lru_cache(maxsize=32)
+def _insar_meta_from_columns(columns):
+    headings = pd.Index(columns)
+    isdate = headings.str.startswith('20')
+    if not isdate.any():
+        raise Exception("No date columns (headings starting '20') found in Data.")
+    idx_firstdate = int(isdate.argmax())
+    date_cols = columns[idx_firstdate:]
+    dates = date2num(pd.to_datetime(list(date_cols), format='%Y%m%d', cache=True).to_numpy())
+    dates.setflags(write=False) # shared between every caller, so nobody gets to edit it in place
+    return idx_firstdate, date_cols, dates
+
+def _gmt_distance_to_degrees(distance):
+    '''Converts a GMT distance string (eg '250e', '0.5k', '3s', or a bare number of degrees) to degrees of latitude.'''
+    distance = str(distance)
+    metres_per_degree = 2*np.pi*6371008.8/360
+    units = {'e':1/metres_per_degree, 'k':1000/metres_per_degree, 'f':0.3048/metres_per_degree, 'M':1609.344/metres_per_degree, 'n':1852/metres_per_degree, 'd':1, 'm':1/60, 's':1/3600}
+    if distance[-1] in units:
+        return float(distance[:-1]) * units[distance[-1]]
+    return float(distance)
+
+def _haversine_m(lat1,lon1,lat2,lon2):
+    '''Great circle distance in metres between points given in degrees, using the haversine formula on a spherical Earth of mean radius 6371008.8m. Accepts scalars or arrays, so whole sets of segments can be measured in one call.'''
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin(0.5*(lat2-lat1))**2 + np.cos(lat1)*np.cos(lat2)*np.sin(0.5*(lon2-lon1))**2
+    return 2*6371008.8*np.arcsin(np.sqrt(a))
 
 def create_dateticks():
     '''Returns a nice premade list of dateticks every 3 months from 2015 to 2018. Helpful shortcut.'''